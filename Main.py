@@ -1,23 +1,51 @@
 ##step 1 get data
 import requests
-import pandas as pd
-from notion_client import Client
+from requests.adapters import HTTPAdapter, Retry
+from concurrent.futures import ThreadPoolExecutor
+import orjson
 import logging
+import shelve
 import re
 import json
 import os
-import time
 
 # Load NOTION_API_KEY from project document (config.json)
 CONFIG_FILE = "config.json"
-HEADERS = {}
+# On-disk cache of formatted rich_text, keyed by block id and
+# last_edited_time so re-runs only reprocess edited blocks
+CACHE_FILE = ".notion_cache"
+
+# Shared session so every Notion call reuses the same pooled connections
+# instead of paying a fresh TCP+TLS handshake per request. Retries (including
+# 429 rate limiting) are handled by urllib3's Retry on the mounted adapter.
+def _build_adapter(max_retries=3):
+    # pool_block caps total connections at pool_maxsize (sized for the
+    # fetch worker pool), so concurrent workers wait for a warm keep-alive
+    # connection instead of opening and discarding extra ones past the
+    # pool limit
+    return HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=16,
+        pool_block=True,
+        max_retries=Retry(
+            total=max_retries,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            # Retry's default allowed_methods excludes PATCH, which would
+            # leave the upload path with no 429/5xx protection at all
+            allowed_methods=frozenset({"GET", "PATCH"}),
+        ),
+    )
+
+SESSION = requests.Session()
+SESSION.mount("https://", _build_adapter())
 
 def load_notion_api_key():
     """
     Load NOTION_API_KEY from config.json. If not found, guide user to create it.
     """
     if not os.path.exists(CONFIG_FILE):
-        logging.error(f"找不到 {CONFIG_FILE}，请在项目根目录创建该文件并写入 NOTION_API_KEY。示例: { '{"NOTION_API_KEY": "your_secret_key"}' }")
+        logging.error(f'找不到 {CONFIG_FILE}，请在项目根目录创建该文件并写入 NOTION_API_KEY。示例: {{"NOTION_API_KEY": "your_secret_key"}}')
         raise FileNotFoundError(f"缺少 {CONFIG_FILE}")
     with open(CONFIG_FILE, "r", encoding="utf-8") as f:
         try:
@@ -36,234 +64,268 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
-# Used to recursively get all blocks and their child blocks
-def get_all_blocks(block_id, max_retries=3):
+# Fetch the direct children of a single block, following pagination
+def fetch_children(block_id):
     url = f"https://api.notion.com/v1/blocks/{block_id}/children?page_size=100"
     blocks = []
     has_more = True
     start_cursor = None
 
     while has_more:
-        attempt = 0
-        data = None
-        while attempt < max_retries:
-            try:
-                params = {"start_cursor": start_cursor} if start_cursor else None
-                response = requests.get(url, headers=HEADERS, params=params)
-                if response.ok:
-                    logging.info(f"访问成功：{url}")
-                response.raise_for_status()
-                data = response.json()
-                break
-            except requests.exceptions.RequestException as e:
-                attempt += 1
-                if attempt < max_retries:
-                    logging.warning(f"访问失败（第{attempt}次），准备重试... 错误：{e}")
-                    time.sleep(min(2 * attempt, 5))
-                else:
-                    logging.error(f"访问失败，已达到最大重试次数 {max_retries}。错误：{e}")
-                    return blocks
-            except Exception as e:
-                logging.error(f"获取 blocks 发生未预期错误：{e}")
-                return blocks
-
-        results = data.get('results', []) if data else []
-        for block in results:
-            blocks.append(block)
-            # If the block has children, recursively get them
-            if block.get('has_children', False):
-                child_blocks = get_all_blocks(block['id'], max_retries=max_retries)
-                blocks.extend(child_blocks)
+        try:
+            params = {"start_cursor": start_cursor} if start_cursor else None
+            response = SESSION.get(url, params=params, timeout=30)
+            if response.ok:
+                logging.info(f"访问成功：{url}")
+            response.raise_for_status()
+            data = orjson.loads(response.content)
+        except requests.exceptions.RequestException as e:
+            logging.error(f"访问失败，重试后仍未成功。错误：{e}")
+            return blocks
+        except Exception as e:
+            logging.error(f"获取 blocks 发生未预期错误：{e}")
+            return blocks
+
+        blocks.extend(data.get('results', []))
+        has_more = data.get('has_more', False)
+        start_cursor = data.get('next_cursor')
+
+    return blocks
 
-        has_more = data.get('has_more', False) if data else False
-        start_cursor = data.get('next_cursor') if data else None
+# Used to get all blocks and their child blocks, level by level. All child
+# fetches for one level run in parallel over the shared session, so total
+# latency scales with tree depth instead of block count.
+def get_all_blocks(block_id):
+    children_of = {}
+    frontier = [block_id]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        while frontier:
+            for parent_id, children in zip(frontier, executor.map(fetch_children, frontier)):
+                children_of[parent_id] = children
+            frontier = [
+                block['id']
+                for parent_id in frontier
+                for block in children_of[parent_id]
+                if block.get('has_children', False)
+            ]
+
+    # Flatten back to document order (each block followed by its
+    # descendants), matching the old recursive depth-first output
+    blocks = []
+    def _flatten(parent_id):
+        for block in children_of.get(parent_id, []):
+            blocks.append(block)
+            _flatten(block['id'])
+    _flatten(block_id)
 
     logging.info(f"Fetched {len(blocks)} blocks from Notion.")
     return blocks
 
-def get_notion_page_content(page_id, max_retries=3):
+def get_notion_page_content(page_id):
     logging.info(f"Getting content for Notion page: {page_id}")
-    blocks = get_all_blocks(page_id, max_retries=max_retries)
+    blocks = get_all_blocks(page_id)
     if not blocks:
         logging.warning("No blocks found for the given page.")
     return blocks
 
 
-## Step 2: Convert blocks to DataFrame
-def blocks_to_dataframe(blocks):
-    data = []
+## Step 2: Convert blocks to plain records
+# Per-type content extractors; dispatch below is a single dict lookup
+# instead of walking an if/elif chain per block
+# Interned key constants: comparisons against them in the hot loops below
+# short-circuit on identity before falling back to a character compare
+_TEXT = 'text'
+_EQUATION = 'equation'
+
+def _rt_to_str(rich_text):
+    # Single place that flattens a rich_text array to a string; equations
+    # come back as "$$ expr $$" so the formatter can re-tokenize them.
+    # Other item types (mentions etc.) are skipped, as before. The walrus
+    # reads item['type'] once per item, and plain concatenation beats an
+    # f-string for stitching three pieces
+    return ''.join(
+        item['text']['content'] if t == _TEXT
+        else '$$ ' + item['equation']['expression'] + ' $$'
+        for item in rich_text
+        if (t := item['type']) == _TEXT or t == _EQUATION
+    )
+
+def _extract_rich_text(block):
+    return _rt_to_str(block[block['type']]['rich_text'])
+
+def _extract_code(block):
+    # Code blocks carry rich_text in current API versions; the bare 'text'
+    # shape is kept as a fallback for older payloads
+    if 'rich_text' in block['code']:
+        return _extract_rich_text(block)
+    return block['code']['text'][0]['text']['content']
+
+def _extract_equation(block):
+    # Equation blocks have a single expression
+    return '$$ ' + block['equation']['expression'] + ' $$'
+
+_HANDLERS = {
+    'paragraph': _extract_rich_text,
+    'heading_1': _extract_rich_text,
+    'heading_2': _extract_rich_text,
+    'heading_3': _extract_rich_text,
+    'quote': _extract_rich_text,
+    'bulleted_list_item': _extract_rich_text,
+    'code': _extract_code,
+    'equation': _extract_equation,
+}
+
+# Generator: records stream through the combine and upload steps without
+# ever being collected into an intermediate list
+def blocks_to_records(blocks):
+    count = 0
+    handlers_get = _HANDLERS.get  # local bind for the per-block lookup
     for block in blocks:
         block_type = block['type']
-        content = ''
-        
-        # Handle block types with rich_text
-        if 'rich_text' in block.get(block_type, {}):
-            for item in block[block_type]['rich_text']:
-                if item['type'] == 'text':
-                    content += item['text']['content']
-                elif item['type'] == 'equation':
-                    content += f"$$ {item['equation']['expression']} $$"
-        # Handle other types of blocks, such as code blocks
-        elif block_type == 'code':
-            content += block['code']['text'][0]['text']['content']
-        # Handle quote blocks
-        elif block_type == 'quote':
-            for item in block['quote']['rich_text']:
-                if item['type'] == 'text':
-                    content += item['text']['content']
-                elif item['type'] == 'equation':
-                    content += f"$$ {item['equation']['expression']} $$"
-        # Handle equation blocks (block type 'equation')
-        elif block_type == 'equation':
-            # Equation blocks have a single expression
-            content += f"$$ {block['equation']['expression']} $$"
-        # Other possible block types can be added here
-
-        data.append({'id': block['id'], 'type': block_type, 'content': content})
-    
-    logging.info(f"Converted {len(data)} blocks to DataFrame.")
-    return pd.DataFrame(data)
-
-def to_dataframe_safe(blocks):
+        handler = handlers_get(block_type)
+        if handler is not None:
+            content = handler(block)
+        elif 'rich_text' in block.get(block_type, {}):
+            # Unlisted block types that still carry rich_text
+            content = _extract_rich_text(block)
+        else:
+            content = ''
+
+        count += 1
+        yield {
+            'id': block['id'],
+            'type': block_type,
+            'content': content,
+            # Carried through for the formatted-content cache key
+            'last_edited_time': block.get('last_edited_time', ''),
+        }
+
+    logging.info(f"Converted {count} blocks to records.")
+
+def to_records_safe(blocks):
     try:
-        df_local = blocks_to_dataframe(blocks)
+        yield from blocks_to_records(blocks)
     except Exception as e:
-        logging.error(f"Error converting blocks to DataFrame: {e}")
-        df_local = pd.DataFrame([])
-    return df_local
+        logging.error(f"Error converting blocks to records: {e}")
 
 ## Step 3: Process content, extract formulas and format
+# Single alternation compiled once at import: $$...$$ (tried first, may
+# span lines) or inline $...$ (single line, as before). The inline branch
+# needs two guards to tokenize exactly like the old block-then-inline
+# passes around unpaired dollars: its content can never contain a $ (the
+# old lazy .+? stopped at the first one anyway), and its closing $ must
+# not be the opening of a $$...$$ equation further right — in the old
+# order that block was carved out first, leaving the would-be inline
+# opener unpaired. Without the lookahead, "price $5 and $$e$$" turned
+# "5 and" into a bogus equation.
+_EQ_PATTERN = r'\$\$(?s:(?P<block>.+?))\$\$|\$(?P<inline>[^$\n]+?)\$(?!\$(?s:.+?)\$\$)'
+_EQ_RE = re.compile(_EQ_PATTERN)
+
+# Optional: google-re2 runs the pattern as a linear-time automaton, which
+# wins on very large blocks where re's backtracking .+? gets expensive.
+# Its FFI overhead loses on small inputs, so it only kicks in past a size
+# threshold, and plain re is used when it is not installed. RE2 has no
+# lookaround, so the guarded pattern fails to compile there and the fast
+# path disables itself rather than tokenize differently from re
+try:
+    import re2 as _re2
+    _EQ_RE2 = _re2.compile(_EQ_PATTERN)
+except Exception:
+    _EQ_RE2 = None
+_RE2_MIN_LEN = 4096
+
 def format_content_for_notion(block):
-    # Improved: Use regex to find all $$equation$$ and convert to equation blocks
-    if isinstance(block, str):
-        # Find all $$...$$ and split text accordingly
-        # Support multi-line equations by using DOTALL
-        pattern = re.compile(r'\$\$(.+?)\$\$', re.DOTALL)
-        parts = []
-        last_end = 0
-        for m in pattern.finditer(block):
-            # Add text before equation
-            if m.start() > last_end:
-                text_part = block[last_end:m.start()]
-                if text_part:
-                    parts.append({
-                        "type": "text",
-                        "text": {"content": text_part}
-                    })
-            # Add equation
-            eq = m.group(1).strip()
-            if eq:
-                parts.append({
-                    "type": "equation",
-                    "equation": {"expression": eq}
-                })
-            last_end = m.end()
-        # Add any remaining text
-        if last_end < len(block):
-            text_part = block[last_end:]
+    # Single-pass tokenizer, as a generator: for each match yield the text
+    # gap since the previous one, then an equation part for whichever
+    # group matched — no intermediate parts list
+    if not isinstance(block, str):
+        # If the block is already a dictionary, pass it through directly
+        yield block
+        return
+    if _EQ_RE2 is not None and len(block) > _RE2_MIN_LEN:
+        matcher = _EQ_RE2
+    else:
+        matcher = _EQ_RE
+    last_end = 0
+    for m in matcher.finditer(block):
+        # Text before equation
+        if m.start() > last_end:
+            text_part = block[last_end:m.start()]
             if text_part:
-                parts.append({
+                yield {
                     "type": "text",
                     "text": {"content": text_part}
-                })
-        # After extracting $$...$$ equations, handle inline $...$ equations within text parts
-        final_parts = []
-        inline_pattern = re.compile(r'\$(.+?)\$')
-        for part in parts:
-            if part.get('type') == 'text':
-                text = part['text']['content']
-                last = 0
-                for m in inline_pattern.finditer(text):
-                    if m.start() > last:
-                        txt = text[last:m.start()]
-                        if txt:
-                            final_parts.append({'type': 'text', 'text': {'content': txt}})
-                    expr = m.group(1).strip()
-                    if expr:
-                        final_parts.append({'type': 'equation', 'equation': {'expression': expr}})
-                    last = m.end()
-                # remaining text
-                if last < len(text):
-                    rem = text[last:]
-                    if rem:
-                        final_parts.append({'type': 'text', 'text': {'content': rem}})
-            else:
-                # equation blocks pass through
-                final_parts.append(part)
-        return final_parts
-    else:
-        # If the block is a dictionary, return directly
-        return block
-
-def combine_text_and_equations(df):
-    combined_blocks = []
-
-    for _, row in df.iterrows():
-        content = row['content']
-        notion_block_content = format_content_for_notion(content)
-
-        # Handle divider type (no content needed)
-        if row['type'] == "divider":
-            combined_blocks.append({
-                'type': 'divider',
-                'divider': {}
-            })
-        
-        # Handle heading types (heading_1, heading_2, heading_3)
-        elif row['type'] == "heading_3" or row['type'] == "heading_2" or row['type'] == "heading_1":
-            combined_blocks.append({
-                'type': row['type'],
-                row['type']: {
-                    'rich_text': notion_block_content
-                }
-            })
-        
-        # Handle quote type
-        elif row['type'] == "quote":
-            combined_blocks.append({
-                'type': 'quote',
-                'quote': {
-                    'rich_text': notion_block_content
                 }
-            })
-        
-        # Handle general paragraph type, ensure it's not empty and has correct structure
-        elif row['type'] == "paragraph":
-            if notion_block_content:  # Check that rich_text is not empty
-                combined_blocks.append({
-                    'type': 'paragraph',
-                    'paragraph': {
-                        'rich_text': notion_block_content
-                    }
-                })
-        # Handle other block types (e.g., code)
-        elif row['type'] == "code":
-            combined_blocks.append({
-                'type': 'code',
-                'code': {
-                    'text': notion_block_content,
-                    'language': 'python'  # Set language according to actual situation
-                }
-            })
-        # Other block types can be added here
-        elif row['type'] == "bulleted_list_item":
-            combined_blocks.append({
-                'type': 'bulleted_list_item',
-                'bulleted_list_item': {
-                    'rich_text': notion_block_content
-                }
-            })
-
-    return combined_blocks
-
-def combine_safe(df_local):
+        # The equation itself
+        eq = (m.group('block') or m.group('inline')).strip()
+        if eq:
+            yield {
+                "type": "equation",
+                "equation": {"expression": eq}
+            }
+        last_end = m.end()
+    # Any remaining text
+    if last_end < len(block):
+        text_part = block[last_end:]
+        if text_part:
+            yield {
+                "type": "text",
+                "text": {"content": text_part}
+            }
+
+# Upload-block factories keyed by type; most types just wrap the converted
+# rich_text under their own key, so the shape is computed once here instead
+# of rebuilding the nested dict layout in an if/elif chain per row
+def _rich_text_block(block_type):
+    def build(rich_text):
+        return {'type': block_type, block_type: {'rich_text': rich_text}}
+    return build
+
+_BUILDERS = {
+    # Divider needs no content
+    'divider': lambda rich_text: {'type': 'divider', 'divider': {}},
+    'heading_1': _rich_text_block('heading_1'),
+    'heading_2': _rich_text_block('heading_2'),
+    'heading_3': _rich_text_block('heading_3'),
+    'quote': _rich_text_block('quote'),
+    'paragraph': _rich_text_block('paragraph'),
+    'bulleted_list_item': _rich_text_block('bulleted_list_item'),
+    # Set language according to actual situation
+    'code': lambda rich_text: {'type': 'code', 'code': {'text': rich_text, 'language': 'python'}},
+    # Other block types can be added here
+}
+
+# Generator: yields upload-ready blocks one at a time so the batch
+# uploader can flush each window as soon as it fills. When a cache is
+# given, formatted rich_text is reused for blocks whose id and
+# last_edited_time match a previous run, so only edited blocks pay the
+# tokenizing cost again
+def combine_text_and_equations(records, cache=None):
+    builders_get = _BUILDERS.get  # local bind for the per-row lookup
+    for row in records:
+        row_type = row['type']
+        builder = builders_get(row_type)
+        if builder is None:
+            continue
+        if cache is not None:
+            key = f"{row['id']}:{row['last_edited_time']}"
+            notion_block_content = cache.get(key)
+            if notion_block_content is None:
+                notion_block_content = list(format_content_for_notion(row['content']))
+                cache[key] = notion_block_content
+        else:
+            # Materialized only here, when building the upload payload
+            notion_block_content = list(format_content_for_notion(row['content']))
+        # Skip paragraphs with empty rich_text
+        if row_type == 'paragraph' and not notion_block_content:
+            continue
+        yield builder(notion_block_content)
+
+def combine_safe(records, cache=None):
     try:
-        combined = combine_text_and_equations(df_local)
-        logging.info(f"Combined data contains {len(combined)} blocks.")
+        yield from combine_text_and_equations(records, cache=cache)
     except Exception as e:
         logging.error(f"Error combining text and equations: {e}")
-        combined = []
-    return combined
 
 ##step 4 upload to notion
 def upload_to_notion(page_id, combined_blocks):
@@ -273,10 +335,15 @@ def upload_to_notion(page_id, combined_blocks):
         "children": children_blocks
     }
     try:
-        response = requests.patch(url, json=payload, headers=HEADERS)
+        # orjson already returns UTF-8 bytes: send them as-is (no
+        # re-encode) with an explicit Content-Length so the body is not
+        # measured again downstream. The session's Content-Type header
+        # marks it as JSON
+        body = orjson.dumps(payload)
+        response = SESSION.patch(url, data=body, headers={"Content-Length": str(len(body))}, timeout=30)
         response.raise_for_status()
         logging.info(f"Successfully uploaded {len(children_blocks)} blocks to Notion page {page_id}.")
-        return response.json()
+        return orjson.loads(response.content)
     except requests.exceptions.RequestException as e:
         logging.error(f"Failed to upload blocks to Notion: {e}")
         return None
@@ -284,13 +351,31 @@ def upload_to_notion(page_id, combined_blocks):
         logging.error(f"Unexpected error during upload: {e}")
         return None
     
-# Batch upload in chunks to avoid rate limits
-def upload_blocks_in_batches(page_id, combined_blocks, batch_size=10):
-    total = len(combined_blocks)
-    for i in range(0, total, batch_size):
-        batch = combined_blocks[i:i+batch_size]
-        logging.info(f"Uploading blocks {i+1} to {i+len(batch)} of {total}")
+# Batch upload in chunks: Notion accepts up to 100 children per PATCH, so a
+# full batch saves ~10 round trips over the old size of 10. Batches must go
+# out strictly one after another — append-children adds at the end of the
+# page in server processing order, so concurrent PATCHes could land out of
+# order and shuffle the rebuilt page in batch-size chunks.
+def upload_blocks_in_batches(page_id, combined_blocks, batch_size=100):
+    # combined_blocks may be any iterable; each window is flushed as soon
+    # as it fills, so only batch_size blocks are held here at a time
+    total = 0
+    batch = []
+    for block in combined_blocks:
+        batch.append(block)
+        if len(batch) == batch_size:
+            total += batch_size
+            logging.info(f"Uploading blocks {total - batch_size + 1} to {total}")
+            upload_to_notion(page_id, batch)
+            batch = []
+    if batch:
+        logging.info(f"Uploading blocks {total + 1} to {total + len(batch)}")
         upload_to_notion(page_id, batch)
+        total += len(batch)
+    if total:
+        logging.info(f"Finished uploading {total} blocks.")
+    else:
+        logging.warning("No data to upload to Notion.")
 
 
 
@@ -299,12 +384,13 @@ def upload_blocks_in_batches(page_id, combined_blocks, batch_size=10):
 def main():
     # Load API key from config and set headers
     api_key = load_notion_api_key()
-    global HEADERS
-    HEADERS = {
+    # The session owns the headers; every request inherits them with no
+    # per-call merge
+    SESSION.headers.update({
         "Authorization": f"Bearer {api_key}",
         "Notion-Version": "2022-06-28",
         "Content-Type": "application/json"
-    }
+    })
 
     # Prompt PAGE_ID at runtime
     page_id = input("请输入 Notion 页面 ID（PAGE_ID）: ").strip()
@@ -316,23 +402,33 @@ def main():
     except ValueError:
         logging.warning("输入的重试次数不是有效数字，默认使用 3 次重试。")
         max_retries = 3
+    if max_retries != 3:
+        SESSION.mount("https://", _build_adapter(max_retries))
 
     # Try to fetch content to confirm access success
-    page_content = get_notion_page_content(page_id, max_retries=max_retries)
+    page_content = get_notion_page_content(page_id)
 
     # If only access confirmation is required, we already logged success when fetching.
-    # Continue original flow: convert and upload
-    df_local = to_dataframe_safe(page_content)
-    combined_data = combine_safe(df_local)
+    # Continue original flow: convert and upload. The convert and combine
+    # steps are lazy generators; blocks stream into the uploader without
+    # intermediate copies of the whole page
+    try:
+        cache = shelve.open(CACHE_FILE)
+    except Exception as e:
+        logging.warning(f"无法打开缓存文件 {CACHE_FILE}，本次运行不使用缓存。错误：{e}")
+        cache = None
+    try:
+        records = to_records_safe(page_content)
+        combined_data = combine_safe(records, cache)
 
-    # Prompt user to manually clear page content in Notion
-    input("请先在 Notion 页面中手动清空内容，然后按回车继续上传... ")
+        # Prompt user to manually clear page content in Notion
+        input("请先在 Notion 页面中手动清空内容，然后按回车继续上传... ")
 
-    # Proceed to upload processed blocks in batches
-    if combined_data:
-        upload_blocks_in_batches(page_id, combined_data, batch_size=10)
-    else:
-        logging.warning("No data to upload to Notion.")
+        # Proceed to upload processed blocks in batches
+        upload_blocks_in_batches(page_id, combined_data)
+    finally:
+        if cache is not None:
+            cache.close()
 
 if __name__ == "__main__":
     main()
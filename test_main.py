@@ -0,0 +1,55 @@
+"""Regression checks for the equation tokenizer in Main.py.
+
+The degenerate unpaired-$ cases pin down the behavior of the fused
+single-pass pattern against the original block-then-inline extraction.
+"""
+import Main
+
+
+def tokenize(content):
+    return list(Main.format_content_for_notion(content))
+
+
+def text(content):
+    return {"type": "text", "text": {"content": content}}
+
+
+def equation(expression):
+    return {"type": "equation", "equation": {"expression": expression}}
+
+
+def test_plain_text_passes_through():
+    assert tokenize("no math here") == [text("no math here")]
+
+
+def test_block_and_inline_equations():
+    assert tokenize("a $$x$$ b $y$ c") == [
+        text("a "), equation("x"), text(" b "), equation("y"), text(" c"),
+    ]
+
+
+def test_block_equation_spans_lines():
+    assert tokenize("$$x =\ny$$") == [equation("x =\ny")]
+
+
+def test_inline_equation_does_not_span_lines():
+    assert tokenize("inline $x\ny$ stays text") == [text("inline $x\ny$ stays text")]
+
+
+def test_unpaired_dollar_before_block_equation():
+    # The inline branch must not take the first $ of a $$...$$ opener as
+    # its closer: "$5 and" is plain text, not an equation
+    assert tokenize("price $5 and $$e$$") == [text("price $5 and "), equation("e")]
+
+
+def test_adjacent_inline_equations_sharing_no_delimiters():
+    assert tokenize("$a$$b$") == [equation("a"), equation("b")]
+
+
+def test_unpaired_opener_before_block_equation():
+    assert tokenize("$x$$y$$") == [text("$x"), equation("y")]
+
+
+def test_dict_content_passes_through_as_single_item():
+    block = {"type": "text", "text": {"content": "already formatted"}}
+    assert tokenize(block) == [block]